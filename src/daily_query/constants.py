@@ -3,3 +3,11 @@
 FOREVER = "2021-05-01"
 FETCH_BATCH = 20
 DEFAULT_COLLECTION = "_default"
+
+# buffered writes
+WRITE_BATCH = 500
+WRITE_INTERVAL = 1.0
+WRITE_QUEUE_SIZE = 10000
+WRITE_RETRIES = 5
+WRITE_BACKOFF = .5
+WRITE_BACKOFF_MAX = 10
@@ -1,24 +1,35 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
 from typing import Tuple, TypeVar, Mapping, Any, Iterable
 
 import pymongo
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
 from pymongo.results import UpdateResult
 
 from daily_query import base
-from daily_query.helpers import parse_dates, isiterable
+from daily_query.helpers import parse_dates, isiterable, mk_date
 from ordered_set import OrderedSet
 
 from .constants import \
-    FOREVER, FETCH_BATCH, DEFAULT_COLLECTION
+    FOREVER, FETCH_BATCH, DEFAULT_COLLECTION, \
+    WRITE_BATCH, WRITE_INTERVAL, WRITE_QUEUE_SIZE, WRITE_RETRIES, \
+    WRITE_BACKOFF, WRITE_BACKOFF_MAX
 
 
 __all__ = (
-    'Doc', 'PyMongo', 'Collection', 'MongoDaily',
+    'Doc', 'PyMongo', 'Collection', 'MongoDaily', 'MongoDailyWriter',
     'mkprojection',
 )
 
 
 Doc = TypeVar("Doc", bound=Mapping[str, Any])
 
+logger = logging.getLogger(__name__)
+
 
 def mkprojection(fields=None, exclude=None):
     """
@@ -196,6 +207,9 @@ class Collection(PyMongo, base.Collection):
     def update_many(self, *args, **kwargs, ):
         return self.collection.update_many(*args, **kwargs)
 
+    def bulk_write(self, requests, **kwargs):
+        return self.collection.bulk_write(requests, **kwargs)
+
     def update_or_create(self, defaults: dict, transform=None, **kwargs) -> Tuple[Doc, UpdateResult]:
         """ Similar to Django's `.update_or_create()`, tries to fetch an object
         from the database based on **kwargs** strict match. If matched, uses **defaults**
@@ -390,4 +404,331 @@ class MongoDaily(PyMongo, base.NoSQLDaily):
 
         return collections, docs_count
 
+    def writer(self, **kwargs) -> 'MongoDailyWriter':
+        """ Buffered writer into the day collections of this database.
+        Cf. `MongoDailyWriter` for accepted kwargs. """
+        return MongoDailyWriter(self, **kwargs)
+
+
+class MongoDailyWriter:
+    """
+    Write-behind buffer for high-rate ingest into day collections.
+
+    Producers enqueue documents and return immediately; a background thread
+    routes each document to its day collection and flushes per-collection
+    ordered `bulk_write()` batches once `batch_size` operations are pending,
+    or every `flush_interval` seconds. Operations on a given day collection
+    are applied in the order they were queued.
+
+    The queue is bounded: when full, producers block for up to `put_timeout`
+    seconds (backpressure), then `queue.Full` is raised.
+    Batches failing on transient errors (network, server selection,
+    retryable writes) are retried with exponential backoff, from `backoff`
+    seconds up to `WRITE_BACKOFF_MAX`, `max_retries` times. Other errors
+    fail the operations right away.
+
+    Retries replay the operations sent by the failed attempt, which the
+    server may have partly applied already. Runs of inserts are replayed
+    unordered, in a single round trip: their duplicate `_id` errors mean
+    they were written by the failed attempt, and count as delivered.
+
+    Documents are shallow-copied when queued: nested values must not be
+    mutated by the producer until written. Always `close()` the writer
+    (or use it as a context manager); writers still open at interpreter
+    exit are closed by an `atexit` hook.
+
+    Examples:
+
+        >>> with MongoDaily('mongodb://localhost:27017/scraped_news_db').writer() as writer:
+        ...     writer.insert({'title': 'Hello'}, day='2022-05-22')
+        ...     writer.update_or_create({'title': 'Hi'}, _day='2022-05-22', link='https://..')
+        >>> writer.stats
+        {'queued': 2, 'delivered': 2, 'failed': 0, 'retried': 0, 'batches': 1, 'pending': 0}
+    """
 
+    # queue marker, that wakes up the writer to stop it, once drained.
+    # flush requests are queued as `threading.Event` markers.
+    _CLOSE = object()
+
+    def __init__(self, daily, day_field=None, batch_size=WRITE_BATCH,
+                 flush_interval=WRITE_INTERVAL, max_queue_size=WRITE_QUEUE_SIZE,
+                 put_timeout=None, max_retries=WRITE_RETRIES, backoff=WRITE_BACKOFF,
+                 on_error=None):
+        """
+        :param MongoDaily daily: daily database to write into
+        :param str day_field: document field holding the day to route to,
+            when not explicitly passed in. Falls back to **today**.
+        :param int batch_size: flush once that many operations are pending.
+        :param float flush_interval: flush pending operations at least
+            every that many seconds.
+        :param int max_queue_size: max queued operations before producers block.
+        :param float put_timeout: max seconds producers block on a full queue,
+            before `queue.Full` is raised. Blocks forever if None.
+        :param int max_retries: retries of a batch failing on transient errors.
+        :param float backoff: seconds before the first retry, doubled
+            on every subsequent retry.
+        :param (str, list, Exception) -> void on_error: called with the
+            collection name, the undelivered operations and the last error.
+        """
+        if not (isinstance(batch_size, int) and batch_size > 0):
+            raise ValueError(f"`batch_size` must be a positive int, passed: {batch_size}")
+        if not (isinstance(max_queue_size, int) and max_queue_size > 0):
+            raise ValueError(f"`max_queue_size` must be a positive int, passed: {max_queue_size}")
+        if not (isinstance(flush_interval, (int, float)) and flush_interval > 0):
+            raise ValueError(f"`flush_interval` must be a positive number, passed: {flush_interval}")
+
+        self.daily = daily
+        self.day_field = day_field
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_error = on_error
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()           # guards `_stats`
+        self._put_cond = threading.Condition()  # guards `_closed`, `_putting`
+        self._putting = 0                       # producers enqueuing
+        self._closed = False
+        self._stats = dict(queued=0, delivered=0, failed=0, retried=0, batches=0)
+
+        self._thread = threading.Thread(
+            target=self._run, name=f"{type(self).__name__}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def stats(self) -> dict:
+        """ Delivery statistics, as operations counts. """
+        with self._lock:
+            return {**self._stats, 'pending': self._queue.qsize()}
+
+    def insert(self, doc: Doc, day=None):
+        """ Queue **doc** for insertion into collection **day**. """
+        doc = dict(doc)     # `InsertOne` sets '_id' on the doc it writes
+        self._put((self._get_day(doc, day), pymongo.InsertOne(doc)))
+
+    def insert_many(self, docs: Iterable[Doc], day=None):
+        for doc in docs:
+            self.insert(doc, day=day)
+
+    def update_or_create(self, defaults: dict, _day=None, **kwargs):
+        """ Queue an upsert into collection **_day**, w/ the semantics of
+        `Collection.update_or_create()`: match on **kwargs**, set **defaults**.
+        Two-staged updates (`transform`) are not supported, since the
+        resulting document is not fetched back. """
+        match = {k: {'$eq': v} for k, v in kwargs.items()}
+        update = {**kwargs, **defaults}
+        update.pop('_id', None)     # MongoDB '_id' is immutable
+        self._put((self._get_day(update, _day),
+                   pymongo.UpdateOne(match, {'$set': update}, upsert=True)))
+
+    def flush(self):
+        """ Block until all operations queued so far are written or dropped.
+        Raises `RuntimeError` if called from the writer thread (eg. `on_error`),
+        or if the writer thread has died. """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError(f"Cannot flush {type(self).__name__} from its own thread")
+        done = threading.Event()
+        if not self._put(done, count=False):
+            return
+        while not done.wait(.1):
+            self._check_alive()
+
+    def close(self):
+        """ Flush pending operations, then stop the writer thread.
+        Further writes raise `RuntimeError`. """
+        with self._put_cond:
+            closing, self._closed = not self._closed, True
+        if threading.current_thread() is self._thread:
+            return      # eg. from `on_error`: the writer stops once drained
+        if closing:
+            try:
+                self._enqueue(self._CLOSE, None)    # wakes up the writer
+            except RuntimeError:
+                pass    # writer thread is gone
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _get_day(self, doc, day=None) -> str:
+        if day is None and self.day_field:
+            day = doc.get(self.day_field)
+        return str(mk_date(day))
+
+    def _put(self, item, count=True) -> bool:
+        """ Enqueue **item**, unless closed. Operations (counted) raise
+        `RuntimeError` if closed, markers are just not enqueued.
+        The closing writer waits for producers still enqueuing (`_putting`),
+        so that blocking on a full queue never holds a lock. """
+        with self._put_cond:
+            if self._closed:
+                if not count:
+                    return False
+                raise RuntimeError(f"Cannot write to closed {type(self).__name__}")
+            self._putting += 1
+        if count:
+            with self._lock:
+                self._stats['queued'] += 1
+        try:
+            self._enqueue(item, self.put_timeout)
+        except (queue.Full, RuntimeError):
+            if count:
+                with self._lock:
+                    self._stats['queued'] -= 1
+            raise
+        finally:
+            with self._put_cond:
+                self._putting -= 1
+                self._put_cond.notify_all()
+        return True
+
+    def _enqueue(self, item, timeout):
+        """ `queue.put()` that gives up with `RuntimeError`
+        if the writer thread dies while waiting for a free slot. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._check_alive()
+            wait = .1 if deadline is None else \
+                max(0, min(.1, deadline - time.monotonic()))
+            try:
+                return self._queue.put(item, timeout=wait)
+            except queue.Full:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def _check_alive(self):
+        if not self._thread.is_alive():
+            raise RuntimeError(f"{type(self).__name__} thread has died")
+
+    def _drained(self) -> bool:
+        """ Whether closed, with nothing left to write. """
+        with self._put_cond:
+            if self._putting:
+                self._put_cond.wait(.1)
+            return not self._putting and self._queue.empty()
+
+    def _run(self):
+        while True:
+            batch, flushes, closing = [], [], self._closed
+            try:
+                self._collect(batch, flushes, closing)
+                self._write(batch)
+            except Exception:
+                logger.exception(f"{type(self).__name__}: writing batch failed")
+            for done in flushes:
+                done.set()
+            if closing and self._drained():
+                break
+
+    def _collect(self, batch, flushes, closing=False):
+        """ Gather queued operations into **batch** until `batch_size` is reached,
+        `flush_interval` has elapsed, or a flush/close is requested.
+        Once closing, only gathers what is already queued. """
+        deadline = time.monotonic() + (0 if closing else self.flush_interval)
+        while len(batch) < self.batch_size:
+            try:
+                timeout = max(0, deadline - time.monotonic())
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if isinstance(item, threading.Event):
+                flushes += [item]
+                break
+            if item is self._CLOSE:
+                break
+            batch += [item]
+
+    def _write(self, batch):
+        by_day = defaultdict(list)
+        for day, op in batch:
+            by_day[day] += [op]
+        for day, ops in by_day.items():
+            self._write_ops(day, ops)
+
+    def _write_ops(self, day, ops):
+        """ Bulk write of **ops** into collection **day**, in order.
+        Transient errors retry the ops sent by the failed attempt (replayed),
+        then the remaining ones. Write errors fail the offending op only,
+        the following ones are resumed.
+
+        Replayed inserts are sent unordered, in one round trip per run of
+        inserts; their duplicate `_id` errors count as delivered. """
+        delivered, undelivered, error = 0, [], None
+        attempt, replayed = 0, 0    # leading ops sent by a failed attempt
+        while ops:
+            chunk, ordered = self._chunk(ops, replayed)
+            try:
+                Collection(day, self.daily.db).bulk_write(chunk, ordered=ordered)
+                delivered += len(chunk)
+                done = len(chunk)
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors') or []
+                if not write_errors:    # eg. write concern error
+                    undelivered, error, ops = undelivered + ops, e, []
+                    continue
+                done = len(chunk) if not ordered else write_errors[0]['index'] + 1
+                failed = 0
+                for err in write_errors:
+                    op = chunk[err['index']]
+                    if err['index'] < replayed and self._is_applied(op, err):
+                        continue
+                    undelivered, error, failed = undelivered + [op], e, failed + 1
+                delivered += done - failed
+            except PyMongoError as e:
+                if attempt < self.max_retries and self._is_transient(e):
+                    with self._lock:
+                        self._stats['retried'] += len(chunk)
+                    time.sleep(min(self.backoff * 2 ** attempt, WRITE_BACKOFF_MAX))
+                    attempt, replayed = attempt + 1, max(replayed, len(chunk))
+                    continue
+                undelivered, error, ops = undelivered + ops, e, []
+                continue
+            except Exception as e:
+                undelivered, error, ops = undelivered + ops, e, []
+                continue
+            ops, replayed = ops[done:], max(0, replayed - done)
+
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['delivered'] += delivered
+            self._stats['failed'] += len(undelivered)
+        if error:
+            logger.warning(f"{type(self).__name__}: {len(undelivered)} "
+                           f"operation(s) not written to '{day}': {error}")
+            if self.on_error:
+                try:
+                    self.on_error(day, undelivered, error)
+                except Exception:
+                    logger.exception(f"{type(self).__name__}: `on_error` failed")
+
+    @staticmethod
+    def _chunk(ops, replayed) -> Tuple[list, bool]:
+        """ Next ops to send, and whether ordered: replayed ops are split
+        into runs of inserts (unordered) and runs of other ops (ordered). """
+        if not replayed:
+            return ops, True
+        is_insert = isinstance(ops[0], pymongo.InsertOne)
+        n = 1
+        while n < replayed and isinstance(ops[n], pymongo.InsertOne) == is_insert:
+            n += 1
+        return ops[:n], not is_insert
+
+    @staticmethod
+    def _is_applied(op, error) -> bool:
+        """ Duplicate `_id` error on a replayed insert:
+        the doc was inserted by the failed attempt. """
+        return isinstance(op, pymongo.InsertOne) and error.get('code') == 11000 \
+            and error.get('keyPattern') == {'_id': 1}
+
+    @staticmethod
+    def _is_transient(error) -> bool:
+        """ Network and server selection errors, or retryable writes. """
+        return isinstance(error, ConnectionFailure) or \
+            error.has_error_label('RetryableWriteError')
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# run the tests against the source tree, w/o `pip install -e .`
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
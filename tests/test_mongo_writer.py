@@ -0,0 +1,324 @@
+import queue
+import threading
+import time
+from unittest import mock
+
+import pymongo
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+
+from daily_query.helpers import mk_date
+from daily_query.mongo import MongoDaily
+
+
+class FakeBulkWrite:
+    """ Stands in for `pymongo.collection.Collection.bulk_write`.
+    Records the calls, and raises the queued **errors** first, if any. """
+
+    def __init__(self, *errors, block=None):
+        self.calls = []
+        self.ordered = []
+        self.errors = list(errors)
+        self.block = block
+        self.called = threading.Event()
+
+    def __call__(self, collection, requests, ordered=True, **kwargs):
+        self.calls += [(collection.name, list(requests))]
+        self.ordered += [ordered]
+        self.called.set()
+        if self.block:
+            self.block.wait()
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+@pytest.fixture
+def daily():
+    client = pymongo.MongoClient('mongodb://localhost:27017', connect=False)
+    yield MongoDaily(client['daily_query_test'])
+    client.close()
+
+
+@pytest.fixture
+def bulk_write():
+    fake = FakeBulkWrite()
+    with mock.patch.object(pymongo.collection.Collection, 'bulk_write',
+                           autospec=True, side_effect=fake):
+        yield fake
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(.01)
+
+
+def test_routes_by_day_field_explicit_day_and_today(daily, bulk_write):
+    with daily.writer(day_field='created') as writer:
+        writer.insert({'n': 1, 'created': '2022-05-21'})
+        writer.insert({'n': 2, 'created': '2022-05-21'}, day='2022-05-22')
+        writer.update_or_create({'t': 1}, _day='2022-05-22', link='x')
+        writer.insert({'n': 3})
+
+    assert bulk_write.calls == [
+        ('2022-05-21', [InsertOne({'n': 1, 'created': '2022-05-21'})]),
+        ('2022-05-22', [
+            InsertOne({'n': 2, 'created': '2022-05-21'}),
+            UpdateOne({'link': {'$eq': 'x'}}, {'$set': {'link': 'x', 't': 1}}, upsert=True),
+        ]),
+        (str(mk_date()), [InsertOne({'n': 3})]),
+    ]
+    assert writer.stats == dict(
+        queued=4, delivered=4, failed=0, retried=0, batches=3, pending=0)
+
+
+def test_update_or_create_matches_on_day_field(daily, bulk_write):
+    with daily.writer() as writer:
+        writer.update_or_create({'t': 1}, _day='2022-05-22', day='monday')
+
+    op = bulk_write.calls[0][1][0]
+    assert op == UpdateOne({'day': {'$eq': 'monday'}},
+                           {'$set': {'day': 'monday', 't': 1}}, upsert=True)
+
+
+def test_queued_documents_are_copied(daily, bulk_write):
+    doc = {'n': 1}
+    with daily.writer() as writer:
+        writer.insert(doc, day='2022-05-22')
+        doc['n'] = 2
+
+    assert bulk_write.calls == [('2022-05-22', [InsertOne({'n': 1})])]
+
+
+def test_flushes_on_batch_size(daily, bulk_write):
+    with daily.writer(batch_size=2, flush_interval=60) as writer:
+        writer.insert({'n': 1}, day='2022-05-22')
+        writer.insert({'n': 2}, day='2022-05-22')
+        wait_until(lambda: bulk_write.calls)
+        assert len(bulk_write.calls[0][1]) == 2
+
+
+def test_flushes_on_interval(daily, bulk_write):
+    with daily.writer(batch_size=100, flush_interval=.05) as writer:
+        writer.insert({'n': 1}, day='2022-05-22')
+        wait_until(lambda: bulk_write.calls)
+
+
+def test_backpressure_raises_queue_full(daily, bulk_write):
+    release = bulk_write.block = threading.Event()
+    writer = daily.writer(batch_size=1, max_queue_size=1)
+    try:
+        writer.insert({'n': 1}, day='2022-05-22')
+        bulk_write.called.wait(5)          # writer thread now busy
+        writer.insert({'n': 2}, day='2022-05-22')
+        writer.put_timeout = .05
+        with pytest.raises(queue.Full):
+            writer.insert({'n': 3}, day='2022-05-22')
+    finally:
+        release.set()
+        writer.close()
+    assert writer.stats['queued'] == writer.stats['delivered'] == 2
+
+
+def dup_key_error(*indexes, key_pattern=None):
+    return BulkWriteError({'writeErrors': [
+        {'index': i, 'code': 11000, 'keyPattern': key_pattern or {'_id': 1}}
+        for i in indexes]})
+
+
+def test_rejects_invalid_thresholds(daily):
+    for kwargs in [dict(batch_size=0), dict(max_queue_size=0),
+                   dict(flush_interval=0), dict(flush_interval=None)]:
+        with pytest.raises(ValueError):
+            daily.writer(**kwargs)
+
+
+def test_retries_transient_errors(daily, bulk_write):
+    bulk_write.errors = [AutoReconnect('down'), AutoReconnect('down')]
+    with daily.writer(backoff=0) as writer:
+        writer.insert({'n': 1}, day='2022-05-22')
+
+    assert len(bulk_write.calls) == 3
+    assert writer.stats['delivered'] == 1
+    assert writer.stats['retried'] == 2
+
+
+def test_fails_fast_on_permanent_errors(daily, bulk_write):
+    unauthorized = OperationFailure('not authorized', 13)
+    bulk_write.errors = [unauthorized]
+    on_error = mock.Mock()
+    with daily.writer(on_error=on_error) as writer:
+        writer.insert({'n': 1}, day='2022-05-22')
+
+    assert len(bulk_write.calls) == 1
+    assert writer.stats['failed'] == 1
+    assert writer.stats['retried'] == 0
+    on_error.assert_called_once_with(
+        '2022-05-22', [InsertOne({'n': 1})], unauthorized)
+
+
+def test_gives_up_after_max_retries(daily, bulk_write):
+    bulk_write.errors = [AutoReconnect('down')] * 3
+    with daily.writer(max_retries=2, backoff=0) as writer:
+        writer.insert({'n': 1}, day='2022-05-22')
+
+    assert len(bulk_write.calls) == 3
+    assert writer.stats['failed'] == 1
+
+
+def test_duplicate_id_on_retry_is_delivered(daily, bulk_write):
+    bulk_write.errors = [AutoReconnect('down'), dup_key_error(0, 1)]
+    with daily.writer(backoff=0) as writer:
+        for n in range(3):
+            writer.insert({'n': n}, day='2022-05-22')
+
+    # inserts applied before the connection dropped are replayed at once
+    assert len(bulk_write.calls) == 2
+    assert bulk_write.ordered == [True, False]
+    assert writer.stats['delivered'] == 3
+    assert writer.stats['failed'] == 0
+
+
+def test_replay_splits_inserts_from_updates(daily, bulk_write):
+    bulk_write.errors = [AutoReconnect('down')]
+    with daily.writer(backoff=0) as writer:
+        writer.insert({'n': 1}, day='2022-05-22')
+        writer.update_or_create({'t': 1}, _day='2022-05-22', link='x')
+        writer.insert({'n': 2}, day='2022-05-22')
+
+    assert [len(ops) for name, ops in bulk_write.calls] == [3, 1, 1, 1]
+    assert bulk_write.ordered == [True, False, True, False]
+    assert writer.stats['delivered'] == 3
+
+
+def test_duplicate_key_on_unique_index_after_retry_fails(daily, bulk_write):
+    unique = dup_key_error(1, key_pattern={'link': 1})
+    bulk_write.errors = [AutoReconnect('down'), unique]
+    on_error = mock.Mock()
+    with daily.writer(backoff=0, on_error=on_error) as writer:
+        for n in range(3):
+            writer.insert({'n': n, 'link': 'x'}, day='2022-05-22')
+
+    assert writer.stats['delivered'] == 2
+    assert writer.stats['failed'] == 1
+    on_error.assert_called_once_with(
+        '2022-05-22', [InsertOne({'n': 1, 'link': 'x'})], unique)
+
+
+def test_duplicate_key_on_upsert_is_not_delivered(daily, bulk_write):
+    bulk_write.errors = [dup_key_error(0)]
+    with daily.writer(backoff=0) as writer:
+        writer.update_or_create({'t': 1}, _day='2022-05-22', link='x')
+
+    assert writer.stats['failed'] == 1
+
+
+def test_write_error_fails_offending_op_only(daily, bulk_write):
+    invalid = BulkWriteError({'writeErrors': [{'index': 1, 'code': 121}]})
+    bulk_write.errors = [invalid]
+    on_error = mock.Mock()
+    with daily.writer(on_error=on_error) as writer:
+        for n in range(3):
+            writer.insert({'n': n}, day='2022-05-22')
+
+    assert bulk_write.calls[-1][1] == [InsertOne({'n': 2})]
+    assert writer.stats['delivered'] == 2
+    assert writer.stats['failed'] == 1
+    on_error.assert_called_once_with('2022-05-22', [InsertOne({'n': 1})], invalid)
+
+
+def test_raising_on_error_does_not_kill_writer(daily, bulk_write):
+    bulk_write.errors = [OperationFailure('not authorized', 13)]
+    on_error = mock.Mock(side_effect=ValueError)
+    with daily.writer(on_error=on_error) as writer:
+        writer.insert({'n': 1}, day='2022-05-21')
+        writer.insert({'n': 2}, day='2022-05-22')
+        writer.flush()
+        writer.insert({'n': 3}, day='2022-05-22')
+        writer.flush()
+
+    on_error.assert_called_once()
+    assert [name for name, ops in bulk_write.calls] == \
+        ['2022-05-21', '2022-05-22', '2022-05-22']
+    assert writer.stats['delivered'] == 2
+    assert writer.stats['failed'] == 1
+
+
+def test_flush_and_close_drain_queue_then_reject_writes(daily, bulk_write):
+    writer = daily.writer(flush_interval=60)
+    writer.insert({'n': 1}, day='2022-05-22')
+    writer.flush()
+    assert writer.stats['delivered'] == 1
+
+    writer.insert({'n': 2}, day='2022-05-22')
+    writer.close()
+    assert writer.stats['delivered'] == 2
+    assert writer.stats['pending'] == 0
+
+    with pytest.raises(RuntimeError):
+        writer.insert({'n': 3}, day='2022-05-22')
+    writer.flush()
+    writer.close()
+
+
+def test_concurrent_producers_honor_put_timeout(daily, bulk_write):
+    release = bulk_write.block = threading.Event()
+    writer = daily.writer(batch_size=1, max_queue_size=1)
+    try:
+        writer.insert({'n': 0}, day='2022-05-22')
+        bulk_write.called.wait(5)          # writer thread now busy
+        writer.insert({'n': 1}, day='2022-05-22')
+        writer.put_timeout = .2
+
+        waits = []
+
+        def produce(n):
+            start = time.monotonic()
+            with pytest.raises(queue.Full):
+                writer.insert({'n': n}, day='2022-05-22')
+            waits.append(time.monotonic() - start)
+
+        producers = [threading.Thread(target=produce, args=(n,)) for n in range(2, 6)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+    finally:
+        release.set()
+        writer.close()
+
+    assert len(waits) == 4
+    assert max(waits) < .6
+    assert writer.stats['queued'] == writer.stats['delivered'] == 2
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_flush_raises_once_writer_thread_died(daily, bulk_write):
+    writer = daily.writer(flush_interval=.05)
+    writer._write = mock.Mock(side_effect=SystemExit)
+    writer.insert({'n': 1}, day='2022-05-22')
+    writer._thread.join(5)
+
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    with pytest.raises(RuntimeError):
+        writer.insert({'n': 2}, day='2022-05-22')
+    writer.close()
+
+
+def test_flush_from_writer_thread_raises(daily, bulk_write):
+    bulk_write.errors = [OperationFailure('not authorized', 13)]
+    raised = []
+
+    def on_error(day, ops, error):
+        try:
+            writer.flush()
+        except RuntimeError as e:
+            raised.append(e)
+
+    with daily.writer(on_error=on_error) as writer:
+        writer.insert({'n': 1}, day='2022-05-22')
+
+    assert len(raised) == 1